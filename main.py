@@ -3,16 +3,28 @@ from fastapi import FastAPI, Depends, HTTPException, status, Request, Form, Head
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from jose import jwt, JWTError, ExpiredSignatureError
-from passlib.context import CryptContext
-from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+import jwt
+from jwt import InvalidTokenError, ExpiredSignatureError, InvalidIssuerError
+from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from datetime import datetime, timezone
+from sqlalchemy import update
+from sqlalchemy.orm import Session, joinedload, selectinload
 from database import Base, engine, get_db
 from models import User,Token, UserPermission
 import pathlib
+import re
+import hashlib
+import threading
 import time
 import os
-from uuid import uuid4
+import secrets
+from functools import lru_cache
+from cachetools import TTLCache
+import redis
 from typing import Optional, Dict, Any
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
@@ -23,8 +35,43 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 app = FastAPI(title="FastAPI Auth with PostgreSQL + JWT (RS256)")
 
 # Static & Templates
-app.mount("/static", StaticFiles(directory="./static"), name="static")
-templates = Jinja2Templates(directory="./templates")
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that sets Cache-Control: long-lived/immutable for content-hashed names (app.3f2a9c1d.css)."""
+
+    _HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if self._HASHED_NAME.search(str(full_path)):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "public, max-age=3600"
+        return response
+
+
+# In production let the reverse proxy serve ./static (e.g. nginx `location /static` with sendfile) and set SERVE_STATIC=0
+if os.getenv("SERVE_STATIC", "1") == "1":
+    app.mount("/static", CachedStaticFiles(directory="./static", check_dir=False, html=False), name="static")
+
+# Compiled templates are cached on disk so restarted workers skip lexing/parsing. auto_reload is off
+# (no stat() per render); set TEMPLATE_AUTO_RELOAD=1 while editing templates.
+# Without JINJA_CACHE_DIR, Jinja uses its own per-user 0700 temp dir and verifies ownership, since
+# cached bytecode is executed on load.
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR")
+if JINJA_CACHE_DIR:
+    os.makedirs(JINJA_CACHE_DIR, mode=0o700, exist_ok=True)
+    _cache_stat = os.stat(JINJA_CACHE_DIR)
+    if _cache_stat.st_uid != os.getuid() or _cache_stat.st_mode & 0o022:
+        raise RuntimeError(f"JINJA_CACHE_DIR {JINJA_CACHE_DIR!r} must be owned by this user and not group/world-writable")
+templates = Jinja2Templates(
+    env=Environment(
+        loader=FileSystemLoader("./templates"),
+        autoescape=True,  # same default Jinja2Templates applies
+        auto_reload=os.getenv("TEMPLATE_AUTO_RELOAD") == "1",
+        bytecode_cache=FileSystemBytecodeCache(directory=JINJA_CACHE_DIR),
+        cache_size=400,
+    )
+)
 
 # Database
 Base.metadata.create_all(bind=engine)
@@ -32,22 +79,55 @@ Base.metadata.create_all(bind=engine)
 # =====================================================
 # Security & JWT Setup
 # =====================================================
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Argon2id with OWASP-recommended parameters (46 MiB, t=3, p=1).
+_ph = PasswordHasher(time_cost=3, memory_cost=46 * 1024, parallelism=1)
 
-PRIVATE_KEY = pathlib.Path("./private.pem").read_text()
-PUBLIC_KEY = pathlib.Path("./public.pem").read_text()
 ALGORITHM = "RS256"
 
+
+@lru_cache(maxsize=None)
+def _load_keys():
+    # Parse the PEMs once; passing raw PEM strings re-parses (and re-checks) the key on every call.
+    # Loaded at import so `gunicorn --preload` parses them in the master and workers share them via fork.
+    private_pem = pathlib.Path("./private.pem").read_bytes()
+    public_pem = pathlib.Path("./public.pem").read_bytes()
+    return load_pem_private_key(private_pem, None), load_pem_public_key(public_pem)
+
+
+if os.getenv("SKIP_KEY_LOAD") == "1":
+    _PRIV_KEY_OBJ = _PUB_KEY_OBJ = None
+else:
+    _PRIV_KEY_OBJ, _PUB_KEY_OBJ = _load_keys()
+
 # JWT Config
 ISSUER = os.getenv("JWT_ISSUER", "myblogapp.com")
 AUDIENCE = os.getenv("JWT_AUDIENCE", "myblogapp_users")
 ACCESS_TOKEN_EXP_MIN = int(os.getenv("ACCESS_TOKEN_EXP_MIN", "15"))
 REFRESH_TOKEN_EXP_DAYS = int(os.getenv("REFRESH_TOKEN_EXP_DAYS", "30"))
 
-# In-memory revocation (for production: use Redis/DB)
+# Constant claims shared by every token of a given type
+_BASE_ACCESS_PAYLOAD = {"iss": ISSUER, "aud": AUDIENCE, "type": "access"}
+_BASE_REFRESH_PAYLOAD = {"iss": ISSUER, "aud": AUDIENCE, "type": "refresh"}
+
+# Cookie lifetimes track token lifetimes so browsers drop them when the JWT expires
+ACCESS_COOKIE_MAX_AGE = ACCESS_TOKEN_EXP_MIN * 60
+REFRESH_COOKIE_MAX_AGE = REFRESH_TOKEN_EXP_DAYS * 86400
+
+# Revocation / refresh-rotation state. With REDIS_URL set, it lives in Redis with a TTL equal
+# to the token's remaining lifetime, so it is bounded and shared across workers. Without it,
+# falls back to per-process sets (single-worker / dev only).
+REDIS_URL = os.getenv("REDIS_URL")
+_redis = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# In-memory fallback, used only when REDIS_URL is unset
 _revoked_jtis = set()
 _valid_refresh_jtis = set()
 
+# Verified-payload cache keyed by SHA-256 of the raw token. Entries are re-checked
+# against exp and the revocation set on every hit; failed verifications are never cached.
+_verify_cache = TTLCache(maxsize=10_000, ttl=60)
+_verify_cache_lock = threading.Lock()
+
 
 # =====================================================
 # Utility Functions
@@ -55,15 +135,65 @@ _valid_refresh_jtis = set()
 def _now_ts() -> int:
     return int(time.time())
 
-# Order matters: first item is default for new hashes.
-pwd_context = CryptContext(schemes=["argon2", "bcrypt"], deprecated="auto")
+def _utc_naive(ts: int) -> datetime:
+    # DB columns store naive UTC datetimes (see models.py)
+    return datetime.fromtimestamp(ts, tz=timezone.utc).replace(tzinfo=None)
+
+def _ttl_until(exp_ts: int) -> int:
+    return max(1, int(exp_ts - time.time()))
+
+def _revoke_jti(jti: Optional[str], exp_ts: int) -> None:
+    if not jti:
+        return
+    if _redis is not None:
+        _redis.set(f"revoked:{jti}", "1", ex=_ttl_until(exp_ts))
+    else:
+        _revoked_jtis.add(jti)
+
+def _is_revoked(jti: Optional[str]) -> bool:
+    if not jti:
+        return False
+    if _redis is not None:
+        return bool(_redis.exists(f"revoked:{jti}"))
+    return jti in _revoked_jtis
+
+def _register_refresh_jti(jti: str, exp_ts: int) -> None:
+    if _redis is not None:
+        _redis.set(f"refresh:{jti}", "1", ex=_ttl_until(exp_ts))
+    else:
+        _valid_refresh_jtis.add(jti)
+
+def _consume_refresh_jti(jti: Optional[str]) -> bool:
+    """Atomically invalidate a refresh JTI; returns False if it was not (or no longer) valid."""
+    if not jti:
+        return False
+    if _redis is not None:
+        return bool(_redis.delete(f"refresh:{jti}"))
+    try:
+        _valid_refresh_jtis.remove(jti)  # single check-and-remove, so concurrent refreshes can't both win
+    except KeyError:
+        return False
+    return True
+
+def _set_auth_cookies(response, access_token: str, refresh_token: str) -> None:
+    response.set_cookie(
+        "access_token", access_token, max_age=ACCESS_COOKIE_MAX_AGE, expires=ACCESS_COOKIE_MAX_AGE,
+        httponly=True, secure=False, samesite="lax",
+    )
+    response.set_cookie(
+        "refresh_token", refresh_token, max_age=REFRESH_COOKIE_MAX_AGE, expires=REFRESH_COOKIE_MAX_AGE,
+        httponly=True, secure=False, samesite="lax",
+    )
 
 def get_password_hash(password: str) -> str:
     # Argon2 has no 72-byte limit; just hash the raw password.
-    return pwd_context.hash(password)
+    return _ph.hash(password)
 
 def verify_password(plain: str, hashed: str) -> bool:
-    return pwd_context.verify(plain, hashed)
+    try:
+        return _ph.verify(hashed, plain)
+    except (VerificationError, InvalidHashError):
+        return False
 
 
 # ---------------- JWT Creation ----------------
@@ -71,18 +201,17 @@ def create_access_token_for_user(
     *, user: User, db: Session,extra: Optional[Dict[str, Any]] = None, expires_minutes: Optional[int] = None
 ) -> Dict[str, Any]:
     iat = _now_ts()
-    expires = datetime.utcnow() + timedelta(minutes=expires_minutes or ACCESS_TOKEN_EXP_MIN)
-    jti = str(uuid4())
+    exp_ts = iat + (expires_minutes or ACCESS_TOKEN_EXP_MIN) * 60
+    expires = _utc_naive(exp_ts)
+    jti = secrets.token_urlsafe(16)
 
     payload = {
-        "iss": ISSUER,
+        **_BASE_ACCESS_PAYLOAD,
         "sub": f"user_{user.id}",
-        "aud": AUDIENCE,
         "iat": iat,
         "nbf": iat,
-        "exp": expires,
+        "exp": exp_ts,
         "jti": jti,
-        "type": "access",
         "user_id": user.id,
         "email": getattr(user, "email", None),
         "role": getattr(user, "role", "user"),
@@ -93,10 +222,9 @@ def create_access_token_for_user(
     if extra:
         payload.update(extra)
 
-    token = jwt.encode(payload, PRIVATE_KEY, algorithm=ALGORITHM)
+    token = jwt.encode(payload, _PRIV_KEY_OBJ, algorithm=ALGORITHM)
     token_rec = Token(user_id=user.id, jti=jti, token_type="access", expires_at=expires)
-    db.add(token_rec)
-    db.commit()
+    db.add(token_rec)  # caller commits
     return {"token": token, "jti": jti, "exp": expires}
 
 
@@ -104,26 +232,24 @@ def create_refresh_token_for_user(
     *, user: User, db: Session,expires_days: Optional[int] = None
 ) -> Dict[str, Any]:
     iat = _now_ts()
-    expires = datetime.utcnow() + timedelta(days=expires_days or REFRESH_TOKEN_EXP_DAYS)
-    jti = str(uuid4())
+    exp_ts = iat + (expires_days or REFRESH_TOKEN_EXP_DAYS) * 86400
+    expires = _utc_naive(exp_ts)
+    jti = secrets.token_urlsafe(16)
 
     payload = {
-        "iss": ISSUER,
+        **_BASE_REFRESH_PAYLOAD,
         "sub": f"user_{user.id}",
-        "aud": AUDIENCE,
         "iat": iat,
         "nbf": iat,
-        "exp": expires,
+        "exp": exp_ts,
         "jti": jti,
-        "type": "refresh",
         "user_id": user.id,
     }
 
-    token = jwt.encode(payload, PRIVATE_KEY, algorithm=ALGORITHM)
+    token = jwt.encode(payload, _PRIV_KEY_OBJ, algorithm=ALGORITHM)
     token_rec = Token(user_id=user.id, jti=jti, token_type="refresh", expires_at=expires)
     db.add(token_rec)
-    db.commit()
-    _valid_refresh_jtis.add(jti)  # store refresh JTI
+    _register_refresh_jti(jti, exp_ts)  # store refresh JTI
     return {"token": token, "jti": jti, "exp": expires}
 
 
@@ -131,24 +257,41 @@ def create_refresh_token_for_user(
 def verify_jwt_token_strict(token: str, *, check_audience: bool = True, check_issuer: bool = True):
     if not token:
         raise HTTPException(status_code=401, detail="Missing token")
+
+    cache_key = (hashlib.sha256(token.encode()).digest(), check_audience, check_issuer)
+    with _verify_cache_lock:
+        cached = _verify_cache.get(cache_key)
+    if cached is not None:
+        if cached["exp"] <= _now_ts():
+            with _verify_cache_lock:
+                _verify_cache.pop(cache_key, None)
+            raise HTTPException(status_code=401, detail="Token expired")
+        if _is_revoked(cached.get("jti")):
+            raise HTTPException(status_code=401, detail="Token revoked")
+        return cached
+
     try:
-        decode_kwargs = {"algorithms": [ALGORITHM]}
-        if check_audience:
-            payload = jwt.decode(token, PUBLIC_KEY, algorithms=[ALGORITHM], audience=AUDIENCE)
-        else:
-            payload = jwt.decode(token, PUBLIC_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(
+            token,
+            _PUB_KEY_OBJ,
+            algorithms=[ALGORITHM],
+            audience=AUDIENCE if check_audience else None,
+            issuer=ISSUER if check_issuer else None,
+            options={"verify_aud": check_audience, "verify_iss": check_issuer},
+        )
     except ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
-    except JWTError as e:
-        raise HTTPException(status_code=401, detail=f"Token invalid: {str(e)}")
-
-    if check_issuer and payload.get("iss") != ISSUER:
+    except InvalidIssuerError:
         raise HTTPException(status_code=401, detail="Invalid token issuer")
+    except InvalidTokenError as e:
+        raise HTTPException(status_code=401, detail=f"Token invalid: {str(e)}")
 
     jti = payload.get("jti")
-    if jti in _revoked_jtis:
+    if _is_revoked(jti):
         raise HTTPException(status_code=401, detail="Token revoked")
 
+    with _verify_cache_lock:
+        _verify_cache[cache_key] = payload
     return payload
 
 
@@ -157,12 +300,12 @@ def verify_jwt_token_strict(token: str, *, check_audience: bool = True, check_is
 # =====================================================
 
 @app.get("/", response_class=HTMLResponse)
-def root(request: Request):
+async def root(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
 
 @app.get("/signup", response_class=HTMLResponse)
-def signup_page(request: Request):
+async def signup_page(request: Request):
     return templates.TemplateResponse("signup.html", {"request": request})
 
 
@@ -173,7 +316,7 @@ def register_user(username: str = Form(...), password: str = Form(...), db: Sess
         raise HTTPException(status_code=400, detail="Username already exists")
     user = User(username=username, hashed_password=get_password_hash(password))
     db.add(user)
-    db.commit()
+    db.flush()  # assigns user.id without ending the transaction
 
     # Optionally add default permissions
     db.add(UserPermission(user_id=user.id, permission="create_post"))
@@ -184,21 +327,21 @@ def register_user(username: str = Form(...), password: str = Form(...), db: Sess
 
 @app.post("/login")
 def login_user(username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == username).first()
+    user = db.query(User).options(joinedload(User.permissions)).filter(User.username == username).first()
     if not user or not verify_password(password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     access = create_access_token_for_user(user=user,db=db)
     refresh = create_refresh_token_for_user(user=user,db=db)
+    db.commit()
 
     response = RedirectResponse(url="/protected", status_code=302)
-    response.set_cookie("access_token", access["token"], httponly=True, secure=False, samesite="lax")
-    response.set_cookie("refresh_token", refresh["token"], httponly=True, secure=False, samesite="lax")
+    _set_auth_cookies(response, access["token"], refresh["token"])
     return response
 
 
 @app.get("/protected", response_class=HTMLResponse)
-def protected(request: Request, authorization: str | None = Header(default=None)):
+async def protected(request: Request, authorization: str | None = Header(default=None)):
     token = None
     if authorization and authorization.startswith("Bearer "):
         token = authorization.split(" ")[1]
@@ -208,7 +351,12 @@ def protected(request: Request, authorization: str | None = Header(default=None)
     if not token:
         return RedirectResponse(url="/", status_code=302)
 
-    payload = verify_jwt_token_strict(token)
+    # Without Redis verification is CPU-only (usually a cache hit), so run it on the event loop.
+    # With Redis the revocation check is a blocking round-trip and goes to the threadpool.
+    if _redis is None:
+        payload = verify_jwt_token_strict(token)
+    else:
+        payload = await run_in_threadpool(verify_jwt_token_strict, token)
     username = payload.get("name") or payload.get("email") or f"user_{payload.get('user_id')}"
     return templates.TemplateResponse("protected.html", {"request": request, "username": username})
 
@@ -230,26 +378,25 @@ def refresh_token(request: Request, db: Session = Depends(get_db)):
         raise HTTPException(status_code=401, detail="Not a refresh token")
 
     old_jti = payload.get("jti")
-    if old_jti not in _valid_refresh_jtis:
+    if not _consume_refresh_jti(old_jti):
         raise HTTPException(status_code=401, detail="Refresh token invalid or revoked")
 
     # Revoke old refresh token
-    _valid_refresh_jtis.discard(old_jti)
-    _revoked_jtis.add(old_jti)
+    _revoke_jti(old_jti, payload["exp"])
 
     user_id = payload.get("user_id")
-    user = db.query(User).filter(User.id == user_id).first()
+    user = db.get(User, user_id, options=[selectinload(User.permissions)])
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
 
-    new_access = create_access_token_for_user(user=user)
-    new_refresh = create_refresh_token_for_user(user=user)
+    new_access = create_access_token_for_user(user=user, db=db)
+    new_refresh = create_refresh_token_for_user(user=user, db=db)
+    db.commit()
 
     response = JSONResponse(
         {"message": "Token refreshed", "access_token": new_access["token"], "refresh_token": new_refresh["token"]}
     )
-    response.set_cookie("access_token", new_access["token"], httponly=True, secure=False, samesite="lax")
-    response.set_cookie("refresh_token", new_refresh["token"], httponly=True, secure=False, samesite="lax")
+    _set_auth_cookies(response, new_access["token"], new_refresh["token"])
     return response
 
 
@@ -258,24 +405,23 @@ def refresh_token(request: Request, db: Session = Depends(get_db)):
 # =====================================================
 @app.post("/logout")
 def logout(request: Request, db: Session = Depends(get_db)):
-    refresh_token = request.cookies.get("refresh_token")
-    access_token = request.cookies.get("access_token")
-    if refresh_token:
+    # Each cookie is verified on its own so one bad token doesn't stop the other being revoked.
+    # Tokens used recently are verify-cache hits, so this rarely costs an RSA verification.
+    revoked_jtis = []
+    for cookie_name in ("refresh_token", "access_token"):
+        token = request.cookies.get(cookie_name)
+        if not token:
+            continue
         try:
-            ref_payload = jwt.decode(refresh_token, PUBLIC_KEY, algorithms=[ALGORITHM], audience=AUDIENCE)
-            access_payload = jwt.decode(access_token, PUBLIC_KEY, algorithms=[ALGORITHM], audience=AUDIENCE)
-            ref_jti = ref_payload.get("jti")
-            access_jti = access_payload.get("jti")
-            db_token_ref = db.query(Token).filter(Token.jti == ref_jti).first()
-            db_token_access = db.query(Token).filter(Token.jti == access_jti).first()
-            if db_token_ref:
-                db_token_ref.revoked = True
-                db.commit()
-            if db_token_access:
-                db_token_access.revoked = True
-                db.commit()
-        except Exception:
-            pass
+            payload = verify_jwt_token_strict(token)
+        except HTTPException:
+            continue
+        _revoke_jti(payload.get("jti"), payload["exp"])
+        revoked_jtis.append(payload.get("jti"))
+
+    if revoked_jtis:
+        db.execute(update(Token).where(Token.jti.in_(revoked_jtis)).values(revoked=True))
+        db.commit()
 
     resp = RedirectResponse(url="/", status_code=302)
     resp.delete_cookie("access_token")
@@ -297,14 +443,29 @@ def admin_tokens(request: Request, db: Session = Depends(get_db)):
     # show all tokens (optionally filter by user query param)
     user_q = request.query_params.get("user")
     if user_q:
-        users = db.query(User).filter((User.username == user_q) | (User.email == user_q) | (User.id == user_q)).all()
+        # Try the column the query most likely targets first so each lookup hits a single index,
+        # falling back to username (self-registered users have no email; usernames may be numeric
+        # or contain "@").
+        users = []
+        if user_q.isdecimal() and int(user_q) < 2**31:
+            users = db.query(User).filter(User.id == int(user_q)).all()
+        elif "@" in user_q:
+            users = db.query(User).filter(User.email == user_q).all()
+        if not users:
+            users = db.query(User).filter(User.username == user_q).all()
         if users:
             user_ids = [u.id for u in users]
-            tokens = db.query(Token).filter(Token.user_id.in_(user_ids)).order_by(Token.created_at.desc()).all()
+            tokens = (
+                db.query(Token)
+                .options(selectinload(Token.user))
+                .filter(Token.user_id.in_(user_ids))
+                .order_by(Token.created_at.desc())
+                .all()
+            )
         else:
             tokens = []
     else:
-        tokens = db.query(Token).order_by(Token.created_at.desc()).limit(200).all()
+        tokens = db.query(Token).options(selectinload(Token.user)).order_by(Token.created_at.desc()).limit(200).all()
 
     return templates.TemplateResponse("admin_tokens.html", {"request": request, "tokens": tokens})
 
@@ -319,12 +480,14 @@ def admin_revoke(token_jti: str = Form(...), request: Request = None, db: Sessio
     if payload.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Admins only")
 
-    db_token = db.query(Token).filter(Token.jti == token_jti).first()
-    if not db_token:
+    # Single UPDATE ... RETURNING; expires_at bounds how long the revocation must be remembered
+    row = db.execute(
+        update(Token).where(Token.jti == token_jti).values(revoked=True).returning(Token.expires_at)
+    ).first()
+    if row is None:
         raise HTTPException(status_code=404, detail="Token not found")
-
-    db_token.revoked = True
     db.commit()
+    _revoke_jti(token_jti, int(row.expires_at.replace(tzinfo=timezone.utc).timestamp()))
     return RedirectResponse(url="/admin/tokens", status_code=302)
 
 
@@ -344,13 +507,5 @@ async def global_exception_handler(request: Request, exc: Exception):
     print(f"Unexpected error: {exc}")
     return RedirectResponse(url="/", status_code=302)
 
-@app.exception_handler(Exception)
-async def global_exception_handler(request: Request, exc: Exception):
-    if isinstance(exc, StarletteHTTPException) and exc.status_code in [404, 405]:
-        return RedirectResponse(url="/", status_code=302)
-    # Log other exceptions for debugging
-    print(f"Unexpected error: {exc}")
-    return RedirectResponse(url="/", status_code=302)
-
 if __name__ =="__main__":
     uvicorn.run(app,host="127.0.0.1",port=8000)
\ No newline at end of file
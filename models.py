@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
@@ -29,11 +29,16 @@ class Token(Base):
     token_type = Column(String(50), nullable=False)  # 'access' or 'refresh'
     expires_at = Column(DateTime, nullable=False)
     revoked = Column(Boolean, default=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # admin panel sorts by this
     meta = Column(Text, nullable=True)  # optional metadata (ip, ua) as JSON string
 
     user = relationship("User", back_populates="tokens")
 
+    __table_args__ = (
+        Index("ix_tokens_type_exp", "token_type", "expires_at"),
+        Index("ix_tokens_active", "user_id", postgresql_where=text("revoked = false")),
+    )
+
 
 class UserPermission(Base):
     __tablename__ = "user_permissions"